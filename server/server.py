@@ -20,8 +20,8 @@ import gzip
 import uuid
 import logging
 import signal
-import sys
-from typing import Dict, Any, Optional
+import os
+from typing import Dict, Any, Optional, Union
 
 # 尝试导入音频处理依赖库
 # scipy用于高质量音频重采样，如果未安装则使用简单重采样方法
@@ -34,10 +34,58 @@ except ImportError:
     HAS_SCIPY = False
     print("⚠️ 未安装scipy，将使用简单重采样（建议：pip install scipy numpy）")
 
+# soxr(libsoxr)用于流式多相重采样，在音频块之间保持滤波器状态，避免块边界杂音
+try:
+    import soxr
+    import numpy as np
+    HAS_SOXR = True
+    print("✅ 已安装soxr，将使用流式多相重采样")
+except ImportError:
+    HAS_SOXR = False
+    print("⚠️ 未安装soxr，将使用scipy多相重采样（建议：pip install soxr）")
+
+# numba用于在soxr和scipy都未安装时JIT编译简单重采样循环，避免逐样本的Python解释开销
+# 只在确实会用到简单重采样时才导入，正常部署不承担numba/LLVM的启动开销
+HAS_NUMBA = False
+if not HAS_SOXR and not HAS_SCIPY:
+    try:
+        import numba
+        import numpy as np
+        HAS_NUMBA = True
+    except ImportError:
+        pass
+
+# orjson是C实现的JSON库，可直接解析bytes，未安装时使用标准库json
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# uvloop基于libuv实现事件循环，降低每次await和套接字读写的开销（仅支持Linux/macOS）
+try:
+    import uvloop
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
 # 音频采样率配置
 ESP32_SAMPLE_RATE = 16000  # ESP32端采样率（Hz）
 DOUBAO_SAMPLE_RATE = 24000  # 豆包AI输出采样率（Hz）
 
+# 发往ESP32的音频合并发送配置
+# 连续的音频块合并为一个WebSocket帧发送，减少帧头、系统调用和事件循环唤醒次数
+# 单帧不超过ESP32端8KB的接收缓冲区，避免被拆分接收
+SEND_BATCH_SIZE = 6400      # 单帧最大音频字节数（200ms）
+SEND_BATCH_TIMEOUT = 0.08   # 凑满一帧的最长等待时间（秒）
+
+# 24kHz -> 16kHz 是固定的2/3有理比，抗混叠FIR滤波器在导入时设计一次，所有会话复用
+# 截止频率为插值后奈奎斯特频率的1/3（即8kHz），乘以插值倍数补偿插零带来的增益损失
+RESAMPLE_UP = 2
+RESAMPLE_DOWN = 3
+if HAS_SCIPY:
+    RESAMPLE_FIR = (scipy.signal.firwin(64, 1 / RESAMPLE_DOWN, window=('kaiser', 8.0)) * RESAMPLE_UP).astype(np.float32)
+
 # 豆包AI API配置
 # 注意：以下密钥为示例，请替换为您自己的密钥
 DOUBAO_CONFIG = {
@@ -62,7 +110,7 @@ SESSION_CONFIG = {
         "speaker": "zh_male_yunzhou_jupiter_bigtts",  # TTS发音人
         "audio_config": {
             "channel": 1,           # 音频通道数
-            "format": "pcm",        # 音频格式
+            "format": "pcm_s16le",  # 音频格式（16位小端PCM，与ESP32端格式一致）
             "sample_rate": 24000    # 音频采样率（Hz）
         }
     },
@@ -80,52 +128,182 @@ SESSION_CONFIG = {
 }
 
 # 设置日志配置
-logging.basicConfig(level=logging.INFO)
+# 默认INFO级别，逐音频块的日志为DEBUG级别；可通过环境变量LOG_LEVEL调整（如LOG_LEVEL=WARNING）
+log_level_name = os.environ.get("LOG_LEVEL", "INFO").upper()
+log_level = logging.getLevelName(log_level_name)
+logging.basicConfig(level=log_level if isinstance(log_level, int) else logging.INFO)
 logger = logging.getLogger(__name__)
+if not isinstance(log_level, int):
+    logger.warning(f"无效的日志级别LOG_LEVEL={log_level_name}，已使用INFO")
 
 # 全局变量用于优雅关闭
 server = None
-running = True
+main_loop = None       # 主事件循环，供信号处理函数唤醒
+shutdown_event = None  # 收到停止信号时置位的asyncio.Event
+
+if HAS_NUMBA:
+    # np.frombuffer返回只读数组，签名中需声明readonly
+    @numba.njit(numba.int16[::1](numba.types.Array(numba.int16, 1, 'C', readonly=True)), cache=True)
+    def _decimate_3_to_2(samples):
+        """简单重采样内核：每3个24kHz样本取前2个作为16kHz样本（显式签名，导入时即完成编译）"""
+        n = len(samples)
+        out = np.empty(n // 3 * 2 + n % 3, dtype=np.int16)
+        j = 0
+        for i in range(0, n, 3):
+            out[j] = samples[i]
+            j += 1
+            if i + 1 < n:
+                out[j] = samples[i + 1]
+                j += 1
+        return out
+
+# 每个会话的流式重采样器（session_id -> soxr.ResampleStream 或 PolyphaseResampleStream）
+_streams: Dict[str, Any] = {}
+
+class PolyphaseResampleStream:
+    """
+    基于scipy.signal.upfirdn的流式2/3多相重采样器（未安装soxr时使用）
+    
+    接口与soxr.ResampleStream一致。每次调用保留末尾一段输入作为下一块的历史，
+    使块边界处的输出与整段连续滤波完全一致，避免块边界杂音。
+    输入和输出缓冲区按会话预分配并复用，避免每个音频块重新分配内存。
+    """
+    
+    def __init__(self):
+        self._input = np.empty(0, dtype=np.int16)   # 历史 + 新输入
+        self._input_len = 0                          # _input中的有效样本数
+        self._output = np.empty(0, dtype=np.int16)  # 输出缓冲区
+        self._emitted = 0  # 以历史起点为基准，已经输出的样本数
+    
+    def resample_chunk(self, x, last=False):
+        """
+        重采样一块音频
+        
+        Args:
+            x: 24kHz int16输入样本
+            last (bool): 是否为最后一块，为True时输出滤波器中剩余的全部样本
+            
+        Returns:
+            numpy.ndarray: 16kHz int16输出样本（内部缓冲区的视图，下次调用前有效）
+        """
+        n = self._input_len + len(x)
+        if n > len(self._input):
+            grown = np.empty(max(n, 2 * len(self._input)), dtype=np.int16)
+            grown[:self._input_len] = self._input[:self._input_len]
+            self._input = grown
+        self._input[self._input_len:n] = x
+        self._input_len = n
+        if n == 0:
+            return self._output[:0]
+        
+        y = scipy.signal.upfirdn(RESAMPLE_FIR, self._input[:n], RESAMPLE_UP, RESAMPLE_DOWN)
+        if last:
+            out = self._store(y[self._emitted:])
+            self._input_len = 0
+            self._emitted = 0
+            return out
+        
+        # 只输出所依赖的输入样本已全部到达的部分
+        ready = (RESAMPLE_UP * n + RESAMPLE_DOWN - 1) // RESAMPLE_DOWN
+        out = self._store(y[self._emitted:ready])
+        
+        # 丢弃后续输出不再依赖的输入，丢弃量取RESAMPLE_DOWN的整数倍以保持多相相位
+        first_needed = (RESAMPLE_DOWN * ready - len(RESAMPLE_FIR) + 1) // RESAMPLE_UP
+        drop = max(0, first_needed // RESAMPLE_DOWN * RESAMPLE_DOWN)
+        self._input[:n - drop] = self._input[drop:n]
+        self._input_len = n - drop
+        self._emitted = ready - drop * RESAMPLE_UP // RESAMPLE_DOWN
+        return out
+    
+    def _store(self, samples):
+        """将滤波输出原地取整限幅后写入输出缓冲区"""
+        m = len(samples)
+        if m > len(self._output):
+            self._output = np.empty(max(m, 2 * len(self._output)), dtype=np.int16)
+        np.rint(samples, out=samples)
+        np.clip(samples, -32768, 32767, out=samples)
+        out = self._output[:m]
+        out[:] = samples
+        return out
+
+def get_resample_stream(session_id: str):
+    """
+    获取会话的流式重采样器，不存在时创建
+    
+    Args:
+        session_id (str): 豆包会话ID
+        
+    Returns:
+        流式重采样器，优先使用soxr，其次使用scipy多相滤波；两者都未安装时返回None
+    """
+    if not HAS_SOXR and not HAS_SCIPY:
+        return None
+    stream = _streams.get(session_id)
+    if stream is None:
+        if HAS_SOXR:
+            stream = soxr.ResampleStream(DOUBAO_SAMPLE_RATE, ESP32_SAMPLE_RATE, 1, dtype='int16')
+        else:
+            stream = PolyphaseResampleStream()
+        _streams[session_id] = stream
+    return stream
 
-def resample_audio_24k_to_16k(audio_data: bytes) -> bytes:
+def flush_resample_stream(session_id: str) -> bytes:
     """
-    将24kHz音频重采样为16kHz并转换为int16格式
+    冲刷并移除会话的流式重采样器，取出滤波器中剩余的音频
+    
+    Args:
+        session_id (str): 豆包会话ID
+        
+    Returns:
+        bytes: 剩余的16kHz int16音频数据
+    """
+    stream = _streams.pop(session_id, None)
+    if stream is None:
+        return b''
+    
+    try:
+        tail = stream.resample_chunk(np.zeros(0, dtype=np.int16), last=True)
+        return tail.tobytes()
+    except Exception as e:
+        logger.error(f"冲刷重采样器失败: {e}")
+        return b''
+
+def resample_audio_24k_to_16k(audio_data: bytes, stream=None) -> Union[bytes, memoryview]:
+    """
+    将24kHz int16音频重采样为16kHz int16音频
     
     这是解决音频杂音问题的核心功能。豆包AI输出24kHz音频，而ESP32需要16kHz音频，
-    因此需要进行重采样处理。
+    因此需要进行重采样处理。全程保持int16格式，无需浮点转换和缩放。
+    
+    重采样方式按以下顺序选择：
+    1. 会话的流式重采样器（soxr，或未安装soxr时的scipy多相滤波，见get_resample_stream）
+    2. soxr和scipy都未安装时，使用每3个样本取2个的简单重采样
     
     Args:
-        audio_data (bytes): 原始24kHz音频数据
+        audio_data (bytes): 原始24kHz int16音频数据
+        stream: 会话的流式重采样器，为None时使用简单重采样
         
     Returns:
-        bytes: 重采样后的16kHz音频数据
+        bytes-like: 重采样后的16kHz音频数据；流式重采样时为重采样器输出的字节视图，
+        不额外复制，需在下次调用前使用（如追加到发送缓冲区）
     """
     # 如果没有音频数据，直接返回
     if not audio_data:
         return audio_data
     
     try:
-        # 如果安装了scipy库，使用高质量重采样方法
-        if HAS_SCIPY:
-            # 将音频数据转换为numpy数组（float32格式）
-            audio_samples = np.frombuffer(audio_data, dtype=np.float32)
-            if len(audio_samples) == 0:
-                return audio_data
-            
-            # 计算目标采样点数
-            target_length = int(len(audio_samples) * ESP32_SAMPLE_RATE / DOUBAO_SAMPLE_RATE)
-            
-            # 使用scipy进行重采样
-            resampled_samples = scipy.signal.resample(audio_samples, target_length)
-            
-            # 将float32转换为int16格式
-            # 将浮点数范围[-1.0, 1.0]缩放到整数范围[-32768, 32767]
-            int16_samples = (resampled_samples * 32767).astype(np.int16)
-            return int16_samples.tobytes()
+        # 如果有流式重采样器，使用多相滤波，滤波器状态跨块连续
+        if stream is not None:
+            audio_samples = np.frombuffer(audio_data, dtype=np.int16)
+            return memoryview(stream.resample_chunk(audio_samples, last=False)).cast('B')
+        elif HAS_NUMBA:
+            # 如果没有scipy库但安装了numba，使用JIT编译的简单重采样
+            audio_samples = np.frombuffer(audio_data, dtype=np.int16)
+            return _decimate_3_to_2(audio_samples).tobytes()
         else:
             # 如果没有scipy库，使用简单重采样方法
             # 每3个24kHz样本取2个16kHz样本
-            samples = struct.unpack(f'<{len(audio_data)//4}f', audio_data)
+            samples = struct.unpack(f'<{len(audio_data)//2}h', audio_data)
             resampled = []
             for i in range(0, len(samples), 3):
                 if i < len(samples):
@@ -133,13 +311,14 @@ def resample_audio_24k_to_16k(audio_data: bytes) -> bytes:
                 if i + 1 < len(samples):
                     resampled.append(samples[i + 1])
             
-            # 转换为int16格式
-            int16_samples = [int(max(-32768, min(32767, sample * 32767))) for sample in resampled]
-            return struct.pack(f'<{len(int16_samples)}h', *int16_samples)
+            return struct.pack(f'<{len(resampled)}h', *resampled)
     except Exception as e:
         logger.error(f"音频重采样失败: {e}")
         return audio_data
 
+# 解析豆包响应中的JSON，orjson和标准库json都可以直接接受bytes
+json_loads = orjson.loads if HAS_ORJSON else json.loads
+
 def create_protocol_header(message_type=0b0001, has_event=True, use_json=True, use_gzip=True):
     """
     创建豆包AI协议头
@@ -151,19 +330,37 @@ def create_protocol_header(message_type=0b0001, has_event=True, use_json=True, u
         use_gzip (bool): 是否使用gzip压缩
         
     Returns:
-        bytearray: 协议头数据
+        bytes: 协议头数据
     """
-    header = bytearray()
     header_size = 1
     version = 0b0001
-    header.append((version << 4) | header_size)
     flags = 0b0100 if has_event else 0b0000
-    header.append((message_type << 4) | flags)
     serial = 0b0001 if use_json else 0b0000
     compress = 0b0001 if use_gzip else 0b0000
-    header.append((serial << 4) | compress)
-    header.append(0x00)
-    return header
+    return struct.pack("!BBBB",
+                       (version << 4) | header_size,
+                       (message_type << 4) | flags,
+                       (serial << 4) | compress,
+                       0x00)
+
+def _build_start_connection_message() -> bytes:
+    """构造StartConnection消息（事件1，空JSON负载）"""
+    payload = gzip.compress(b"{}")
+    return b''.join((create_protocol_header(), struct.pack("!II", 1, len(payload)), payload))
+
+# 与会话无关的协议消息在导入时预先构造，每个连接直接复用
+START_CONNECTION_MESSAGE = _build_start_connection_message()
+# StartSession消息中会话ID之前的部分（协议头 + 事件100）
+START_SESSION_PREFIX = create_protocol_header() + struct.pack("!I", 100)
+# StartSession消息中会话ID之后的部分（压缩后的会话配置）
+if HAS_ORJSON:
+    _session_payload = gzip.compress(orjson.dumps(SESSION_CONFIG))
+else:
+    _session_payload = gzip.compress(json.dumps(SESSION_CONFIG, separators=(',', ':')).encode('utf-8'))
+START_SESSION_SUFFIX = struct.pack("!I", len(_session_payload)) + _session_payload
+# 音频消息中会话ID之前的部分（音频消息协议头 + 事件200）
+# PCM音频熵很高，gzip几乎压缩不了，音频消息不压缩直接发送，省去每帧的压缩开销
+AUDIO_MESSAGE_PREFIX = create_protocol_header(message_type=0b0010, use_json=False, use_gzip=False) + struct.pack("!I", 200)
 
 def parse_doubao_response(data: bytes) -> Dict[str, Any]:
     """
@@ -181,39 +378,40 @@ def parse_doubao_response(data: bytes) -> Dict[str, Any]:
     
     try:
         # 解析协议头
-        header_size = (data[0] & 0x0f) * 4
-        message_type = data[1] >> 4
-        message_flags = data[1] & 0x0f
+        version_size, type_flags, serial_compress, _ = struct.unpack_from("!BBBB", data, 0)
+        header_size = (version_size & 0x0f) * 4
+        message_type = type_flags >> 4
+        message_flags = type_flags & 0x0f
         has_event = bool(message_flags & 0b0100)
-        compression = data[2] & 0x0f
+        compression = serial_compress & 0x0f
         use_gzip = bool(compression)
-        use_json = bool(data[2] >> 4)
+        use_json = bool(serial_compress >> 4)
         
-        # 提取有效载荷数据
-        payload = data[header_size:]
+        # 有效载荷从协议头之后开始，直接按偏移量解析，不复制载荷
+        data_len = len(data)
         result = {"message_type": "unknown"}
-        offset = 0
+        offset = header_size
         
         # 解析事件ID
-        if has_event and len(payload) >= offset + 4:
-            result["event"] = int.from_bytes(payload[offset:offset+4], "big")
+        if has_event and data_len >= offset + 4:
+            (result["event"],) = struct.unpack_from("!I", data, offset)
             offset += 4
         
         # 解析会话ID
-        if len(payload) >= offset + 4:
-            session_id_len = int.from_bytes(payload[offset:offset+4], "big")
+        if data_len >= offset + 4:
+            (session_id_len,) = struct.unpack_from("!I", data, offset)
             offset += 4
-            if len(payload) >= offset + session_id_len:
-                session_id = payload[offset:offset+session_id_len]
+            if data_len >= offset + session_id_len:
+                session_id = data[offset:offset+session_id_len]
                 result["session_id"] = session_id.decode('utf-8', errors='ignore')
                 offset += session_id_len
         
         # 解析消息数据
-        if len(payload) >= offset + 4:
-            msg_len = int.from_bytes(payload[offset:offset+4], "big")
+        if data_len >= offset + 4:
+            (msg_len,) = struct.unpack_from("!I", data, offset)
             offset += 4
-            if len(payload) >= offset + msg_len:
-                msg_data = payload[offset:offset+msg_len]
+            if data_len >= offset + msg_len:
+                msg_data = data[offset:offset+msg_len]
                 
                 # 解压缩数据
                 if use_gzip and msg_data:
@@ -227,24 +425,18 @@ def parse_doubao_response(data: bytes) -> Dict[str, Any]:
                     result["message_type"] = "audio"
                     if use_json and msg_data:
                         try:
-                            result["payload"] = json.loads(msg_data.decode('utf-8'))
+                            result["payload"] = json_loads(msg_data)
                         except:
-                            # 不是JSON格式，直接作为音频数据处理
-                            logger.info(f"🎵 接收到豆包音频数据: {len(msg_data)} 字节，正在重采样...")
-                            resampled_audio = resample_audio_24k_to_16k(msg_data)
-                            result["audio_data"] = resampled_audio
-                            logger.info(f"✅ 重采样完成: {len(resampled_audio)} 字节")
+                            # 不是JSON格式，直接作为音频数据处理（24kHz原始数据，由转发任务重采样）
+                            result["audio_data"] = msg_data
                     else:
                         # 直接是音频数据
-                        logger.info(f"🎵 接收到豆包音频数据: {len(msg_data)} 字节，正在重采样...")
-                        resampled_audio = resample_audio_24k_to_16k(msg_data)
-                        result["audio_data"] = resampled_audio
-                        logger.info(f"✅ 重采样完成: {len(resampled_audio)} 字节")
+                        result["audio_data"] = msg_data
                 elif message_type == 0b1001:  # SERVER_FULL_RESPONSE（完整响应）
                     result["message_type"] = "response"
                     if use_json and msg_data:
                         try:
-                            result["payload"] = json.loads(msg_data.decode('utf-8'))
+                            result["payload"] = json_loads(msg_data)
                         except:
                             result["payload"] = msg_data
                     else:
@@ -286,7 +478,9 @@ async def handle_esp32_client(websocket, path):
     
     # 初始化变量
     doubao_ws = None
-    audio_stream_buffer = b''  # 音频流缓冲区
+    session_id = None
+    audio_stream_buffer = bytearray()  # 音频流缓冲区
+    audio_stream_read_pos = 0  # 缓冲区读取位置，已发送的数据不立即删除，避免每次发送都复制剩余数据
     tasks = []  # 存储任务引用以便正确清理
     
     try:
@@ -299,38 +493,32 @@ async def handle_esp32_client(websocket, path):
             DOUBAO_CONFIG['base_url'],
             extra_headers=DOUBAO_CONFIG['headers'],
             ping_interval=None,
+            compression=None,    # 关闭permessage-deflate，协议层已自行gzip控制消息，音频不值得再压缩
         )
         logger.info("✅ 豆包服务器连接成功！")
         
         # 2. 初始化豆包AI会话
         # 2.1 发送StartConnection消息
-        header = create_protocol_header()
-        message = bytearray(header)
-        message.extend((1).to_bytes(4, 'big'))
-        payload = gzip.compress(b"{}")
-        message.extend(len(payload).to_bytes(4, 'big'))
-        message.extend(payload)
-        
         if not doubao_ws.closed:
-            await doubao_ws.send(message)
+            await doubao_ws.send(START_CONNECTION_MESSAGE)
             await doubao_ws.recv()  # 接收确认响应
         
         # 2.2 发送StartSession消息
-        header = create_protocol_header()
-        message = bytearray(header)
-        message.extend((100).to_bytes(4, 'big'))
+        # 只需拼入本会话的ID，其余部分已预先构造
         session_bytes = session_id.encode('utf-8')
-        message.extend(len(session_bytes).to_bytes(4, 'big'))
-        message.extend(session_bytes)
-        payload = gzip.compress(json.dumps(SESSION_CONFIG).encode('utf-8'))
-        message.extend(len(payload).to_bytes(4, 'big'))
-        message.extend(payload)
+        message = b''.join((START_SESSION_PREFIX,
+                            struct.pack("!I", len(session_bytes)),
+                            session_bytes,
+                            START_SESSION_SUFFIX))
         
         if not doubao_ws.closed:
             await doubao_ws.send(message)
             await doubao_ws.recv()  # 接收确认响应
         logger.info("✅ 豆包会话初始化完成")
         
+        # 为本会话创建流式重采样器
+        get_resample_stream(session_id)
+        
         # 向ESP32发送就绪消息
         await safe_send(websocket, json.dumps({
             "type": "ready",
@@ -338,27 +526,80 @@ async def handle_esp32_client(websocket, path):
         }))
         
         # 3. 创建双向数据转发任务
+        # 发往ESP32的数据统一放入发送队列，由独立的写任务发送，
+        # 队列有上限，ESP32发送变慢时会反压到豆包响应的处理，而不是无限堆积
+        esp32_send_queue = asyncio.Queue(maxsize=32)
+        end_of_stream = object()  # 放入发送队列表示豆包响应已结束，写任务发送完剩余数据后退出
+        
+        async def send_to_esp32():
+            """
+            从发送队列取出数据并发送到ESP32，连续的音频块合并为一帧发送
+            """
+            loop = asyncio.get_running_loop()
+            pending = None  # 凑批时取出但放不进当前帧的数据
+            # 合并发送用的缓冲区，整个连接复用；websockets在send()内同步完成帧序列化，发送后即可复用
+            batch = bytearray()
+            
+            while True:
+                if pending is not None:
+                    data, pending = pending, None
+                else:
+                    data = await esp32_send_queue.get()
+                
+                if data is end_of_stream:
+                    return
+                
+                if isinstance(data, bytes):
+                    merged = False  # 只有合并了多个音频块时才使用合并缓冲区
+                    size = len(data)
+                    deadline = loop.time() + SEND_BATCH_TIMEOUT
+                    while size < SEND_BATCH_SIZE:
+                        # 先直接取出队列中已有的数据，队列为空时才限时等待
+                        try:
+                            item = esp32_send_queue.get_nowait()
+                        except asyncio.QueueEmpty:
+                            timeout = deadline - loop.time()
+                            if timeout <= 0:
+                                break
+                            try:
+                                item = await asyncio.wait_for(esp32_send_queue.get(), timeout)
+                            except asyncio.TimeoutError:
+                                break
+                        # 文本消息或放不下的音频留到下一帧，保持发送顺序
+                        if not isinstance(item, bytes) or size + len(item) > SEND_BATCH_SIZE:
+                            pending = item
+                            break
+                        if not merged:
+                            batch.clear()
+                            batch.extend(data)
+                            merged = True
+                        batch.extend(item)
+                        size += len(item)
+                    if merged:
+                        data = batch
+                
+                if not await safe_send(websocket, data):
+                    logger.warning("ESP32连接已关闭，无法发送数据")
+                    return
+        
         async def forward_esp32_to_doubao():
             """
             转发ESP32音频数据到豆包AI
             """
+            # 协议头、事件和会话ID在整个会话中不变，只构造一次
+            audio_prefix = AUDIO_MESSAGE_PREFIX + struct.pack("!I", len(session_bytes)) + session_bytes
+            
             try:
                 async for audio_chunk in websocket:
                     if isinstance(audio_chunk, bytes) and doubao_ws and not doubao_ws.closed:
-                        # 构造并发送音频数据到豆包AI
-                        header = create_protocol_header(message_type=0b0010, use_json=False)
-                        message = bytearray(header)
-                        message.extend((200).to_bytes(4, 'big'))
-                        session_bytes = session_id.encode('utf-8')
-                        message.extend(len(session_bytes).to_bytes(4, 'big'))
-                        message.extend(session_bytes)
-                        compressed_audio = gzip.compress(audio_chunk)
-                        message.extend(len(compressed_audio).to_bytes(4, 'big'))
-                        message.extend(compressed_audio)
+                        # 构造并发送音频数据到豆包AI（一次拼接完成，避免多次扩容）
+                        message = b''.join((audio_prefix,
+                                            struct.pack("!I", len(audio_chunk)),
+                                            audio_chunk))
                         
                         try:
                             await doubao_ws.send(message)
-                            logger.info(f"🎵 转发音频到豆包: {len(audio_chunk)} 字节")
+                            logger.debug("🎵 转发音频到豆包: %d 字节", len(audio_chunk))
                         except Exception as e:
                             logger.warning(f"转发音频到豆包失败: {e}")
                             break
@@ -369,7 +610,7 @@ async def handle_esp32_client(websocket, path):
             """
             转发豆包AI响应到ESP32（流式版本）
             """
-            nonlocal audio_stream_buffer
+            nonlocal audio_stream_buffer, audio_stream_read_pos
             
             try:
                 while True:
@@ -380,33 +621,38 @@ async def handle_esp32_client(websocket, path):
                     
                     # 处理音频数据
                     if "audio_data" in response:
-                        audio_data = response["audio_data"]
+                        msg_data = response["audio_data"]
+                        # 返回值可能是重采样器复用输出缓冲区的视图，下次重采样前必须先消费
+                        # （追加到 audio_stream_buffer），不能直接放入发送队列或保存引用
+                        audio_data = resample_audio_24k_to_16k(msg_data, get_resample_stream(session_id))
+                        logger.debug("🎵 豆包音频重采样: %d -> %d 字节", len(msg_data), len(audio_data))
                         if len(audio_data) > 0:
                             # 将音频数据添加到流缓冲区
-                            audio_stream_buffer += audio_data
-                            logger.debug(f"🔊 添加音频数据到缓冲区: {len(audio_data)} 字节，缓冲区总大小: {len(audio_stream_buffer)} 字节")
+                            audio_stream_buffer.extend(audio_data)
+                            logger.debug("🔊 添加音频数据到缓冲区: %d 字节，缓冲区总大小: %d 字节",
+                                         len(audio_data), len(audio_stream_buffer) - audio_stream_read_pos)
                             
                             # 当缓冲区达到一定大小时，发送给ESP32
                             chunk_size = 1600  # 50ms的音频数据 (16000Hz * 0.05s * 2bytes)
                             
-                            while len(audio_stream_buffer) >= chunk_size:
-                                # 取出一个块发送
-                                chunk = audio_stream_buffer[:chunk_size]
-                                audio_stream_buffer = audio_stream_buffer[chunk_size:]
+                            # 已发送的数据累积到64KB后再统一从缓冲区删除
+                            if audio_stream_read_pos > 65536:
+                                del audio_stream_buffer[:audio_stream_read_pos]
+                                audio_stream_read_pos = 0
+                            
+                            while len(audio_stream_buffer) - audio_stream_read_pos >= chunk_size:
+                                # 取出一个块发送（通过memoryview切片，只复制这一块）
+                                with memoryview(audio_stream_buffer) as view:
+                                    chunk = bytes(view[audio_stream_read_pos:audio_stream_read_pos + chunk_size])
+                                audio_stream_read_pos += chunk_size
                                 
                                 # 检查音频数据有效性（确保是整数采样）
                                 if len(chunk) % 2 != 0:
-                                    logger.debug(f"⚠️ 过滤非整数采样数据: {len(chunk)} 字节")
+                                    logger.debug("⚠️ 过滤非整数采样数据: %d 字节", len(chunk))
                                     continue
                                 
-                                if not await safe_send(websocket, chunk):
-                                    logger.warning("ESP32连接已关闭，无法发送音频")
-                                    return
-                                
-                                logger.info(f"🔊 发送音频块到ESP32: {len(chunk)} 字节")
-                                
-                                # 稍微延迟，保持流式播放的均匀性
-                                await asyncio.sleep(0.01)  # 10ms延迟
+                                await esp32_send_queue.put(chunk)
+                                logger.debug("🔊 发送音频块到ESP32: %d 字节", len(chunk))
                     
                     # 处理其他响应数据
                     elif "payload" in response:
@@ -421,49 +667,54 @@ async def handle_esp32_client(websocket, path):
                                 
                         # 处理TTS结束事件
                         elif event == 559:
-                            # 等待一段时间确保所有音频数据发送完成
-                            await asyncio.sleep(0.2)
+                            # 冲刷重采样器中剩余的音频，下一轮回复时重新创建
+                            audio_stream_buffer.extend(flush_resample_stream(session_id))
                             
                             # TTS结束，发送剩余的音频数据
-                            if len(audio_stream_buffer) > 0:
-                                logger.info(f"🎵 TTS结束，发送剩余音频: {len(audio_stream_buffer)} 字节")
-                                if len(audio_stream_buffer) % 2 == 0:  # 确保整数采样
-                                    if not await safe_send(websocket, audio_stream_buffer):
-                                        logger.warning("ESP32连接已关闭，无法发送剩余音频")
-                                
-                                audio_stream_buffer = b''  # 清空缓冲区
+                            remaining = len(audio_stream_buffer) - audio_stream_read_pos
+                            if remaining > 0:
+                                logger.info(f"🎵 TTS结束，发送剩余音频: {remaining} 字节")
+                                if remaining % 2 == 0:  # 确保整数采样
+                                    with memoryview(audio_stream_buffer) as view:
+                                        tail = bytes(view[audio_stream_read_pos:])
+                                    await esp32_send_queue.put(tail)
                             
-                            # 等待确保剩余音频数据发送完成
-                            await asyncio.sleep(0.1)
+                            # 清空缓冲区
+                            audio_stream_buffer.clear()
+                            audio_stream_read_pos = 0
                             
                             # 再次发送一段静音数据确保缓冲区清空
                             silence_data = bytes([0] * 1024)  # 1KB静音数据
-                            if not await safe_send(websocket, silence_data):
-                                logger.warning("ESP32连接已关闭，无法发送静音数据")
-                            
-                            # 等待确保静音数据发送完成
-                            await asyncio.sleep(0.05)
+                            await esp32_send_queue.put(silence_data)
                             
-                            # 发送明确的停止播放信号
-                            if not await safe_send(websocket, json.dumps({
+                            # 发送明确的停止播放信号（发送队列保证其在全部音频之后发出）
+                            await esp32_send_queue.put(json.dumps({
                                 "type": "tts_end",
                                 "message": "TTS结束，停止流式播放"
-                            })):
-                                logger.warning("ESP32连接已关闭，无法发送停止信号")
+                            }))
                             
                             logger.info("🤖 AI回复结束，已发送停止信号")
                             
             except Exception as e:
                 logger.debug(f"豆包响应转发任务结束: {e}")
+            
+            # 通知写任务豆包响应已结束，队列中剩余的数据仍会发送给ESP32
+            await esp32_send_queue.put(end_of_stream)
         
         # 创建并运行双向转发任务
         task1 = asyncio.create_task(forward_esp32_to_doubao())
         task2 = asyncio.create_task(forward_doubao_to_esp32())
-        tasks = [task1, task2]
+        task3 = asyncio.create_task(send_to_esp32())
+        tasks = [task1, task2, task3]
         
         # 等待任一任务完成或出现异常
         done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
         
+        # 豆包响应结束时，先等待写任务把队列中剩余的音频和停止信号发送完
+        if task2 in done and task3 in pending:
+            await task3
+            pending.discard(task3)
+        
         # 取消未完成的任务
         for task in pending:
             task.cancel()
@@ -480,6 +731,10 @@ async def handle_esp32_client(websocket, path):
             if not task.done():
                 task.cancel()
         
+        # 释放会话的重采样器
+        if session_id is not None:
+            _streams.pop(session_id, None)
+        
         # 关闭豆包WebSocket连接
         if doubao_ws:
             try:
@@ -497,23 +752,19 @@ def signal_handler(signum, frame):
     """
     信号处理函数，用于优雅关闭服务器
     """
-    global running, server
     logger.info("👋 收到停止信号")
-    running = False
     
-    # 关闭服务器
-    if server:
-        server.close()
-    
-    # 退出程序
-    sys.exit(0)
+    # 通知主函数退出等待，由主函数负责关闭服务器
+    # 信号处理函数不在事件循环回调中执行，需通过call_soon_threadsafe唤醒事件循环
+    if main_loop and shutdown_event:
+        main_loop.call_soon_threadsafe(shutdown_event.set)
 
 async def main():
     """
     主函数
     启动WebSocket服务器并等待连接
     """
-    global server, running
+    global server, main_loop, shutdown_event
     
     host = "0.0.0.0"  # 监听所有网络接口
     port = 8888       # 监听端口
@@ -526,17 +777,22 @@ async def main():
     logger.info("=" * 60)
     logger.info("等待ESP32连接...")
     
+    main_loop = asyncio.get_running_loop()
+    shutdown_event = asyncio.Event()
+    
     # 注册信号处理器
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
     try:
-        server = await websockets.serve(handle_esp32_client, host, port)
+        server = await websockets.serve(
+            handle_esp32_client, host, port,
+            compression=None,    # 关闭permessage-deflate，PCM音频压缩收益很小却要多一次zlib
+        )
         logger.info("✅ WebSocket服务器启动成功")
         
-        # 保持服务器运行
-        while running:
-            await asyncio.sleep(1)
+        # 保持服务器运行，直到收到停止信号
+        await shutdown_event.wait()
             
     except Exception as e:
         logger.error(f"服务器运行出错: {e}")
@@ -555,6 +811,10 @@ async def main():
         logger.info("🛑 服务器已停止")
 
 if __name__ == "__main__":
+    if HAS_UVLOOP:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("✅ 使用uvloop事件循环")
+    
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
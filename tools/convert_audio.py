@@ -10,8 +10,9 @@
 功能:
     - 自动扫描 ../main/mock_voices/ 目录中的 MP3 文件
     - 使用 ffmpeg 将 MP3 转换为 16kHz 单声道 16位 PCM 格式
-    - 生成对应的 C 头文件，包含音频数据数组
+    - 通过管道读取 ffmpeg 输出，边解码边生成对应的 C 头文件，包含音频数据数组
     - 支持覆盖已存在的头文件
+    - 多个文件并行转换
 
 依赖:
     - ffmpeg (需要在系统 PATH 中)
@@ -24,9 +25,13 @@ import os
 import sys
 import subprocess
 import tempfile
+import concurrent.futures
 from pathlib import Path
 
 
+READ_BLOCK_SIZE = 64 * 1024  # 从 ffmpeg 管道每次读取的字节数
+
+
 def check_ffmpeg():
     """检查 ffmpeg 是否可用"""
     try:
@@ -39,100 +44,114 @@ def check_ffmpeg():
         return False
 
 
-def convert_mp3_to_pcm(mp3_path, output_path):
+def start_mp3_decoder(mp3_path, stderr_file):
     """
-    使用 ffmpeg 将 MP3 转换为 16kHz 单声道 16位 PCM 格式
+    启动 ffmpeg，将 MP3 解码为 16kHz 单声道 16位 PCM 格式并写到标准输出
+    
+    PCM 数据直接通过管道读取，不经过临时文件，ffmpeg 解码与十六进制编码同时进行。
+    错误信息写入 stderr_file 而不是管道：损坏的 MP3 每个坏帧都会输出一行错误，
+    若 stderr 也用管道且只在 stdout 读完后才读取，管道写满后 ffmpeg 与本脚本会互相等待。
     
     Args:
         mp3_path: 输入的 MP3 文件路径
-        output_path: 输出的 PCM 文件路径
+        stderr_file: 接收 ffmpeg 错误信息的文件对象
     
     Returns:
-        bool: 转换是否成功
+        subprocess.Popen: ffmpeg 进程，从其 stdout 读取 PCM 数据
     """
-    try:
-        cmd = [
-            'ffmpeg',
-            '-i', str(mp3_path),           # 输入文件
-            '-ar', '16000',                # 采样率 16kHz
-            '-ac', '1',                    # 单声道
-            '-f', 's16le',                 # 16位小端格式
-            '-y',                          # 覆盖输出文件
-            str(output_path)               # 输出文件
-        ]
-        
-        result = subprocess.run(cmd, 
-                              stdout=subprocess.DEVNULL, 
-                              stderr=subprocess.PIPE, 
-                              text=True)
-        
-        if result.returncode != 0:
-            print(f"❌ ffmpeg 转换失败: {result.stderr}")
-            return False
-            
-        return True
-        
-    except Exception as e:
-        print(f"❌ 转换过程中发生错误: {e}")
-        return False
+    cmd = [
+        'ffmpeg',
+        '-v', 'error',                 # 只输出错误信息
+        '-i', str(mp3_path),           # 输入文件
+        '-ar', '16000',                # 采样率 16kHz
+        '-ac', '1',                    # 单声道
+        '-f', 's16le',                 # 16位小端格式
+        '-'                            # 输出到标准输出
+    ]
+    
+    return subprocess.Popen(cmd,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=stderr_file)
 
 
-def pcm_to_c_header(pcm_path, header_path, array_name):
+def format_hex_lines(data, bytes_per_line=16, last=True):
     """
-    将 PCM 文件转换为 C 头文件格式
+    将字节数据逐行格式化为 C 数组元素，每行 16 个字节
+    
+    使用 bytes.hex() 一次完成整行的十六进制转换，避免逐字节格式化。
+    每行以 ", " 结尾；last 为 True 时最后一行以 " " 结尾。
     
     Args:
-        pcm_path: PCM 文件路径
+        data: 字节数据
+        bytes_per_line: 每行字节数
+        last: data 是否包含数组的最后一行
+    
+    Yields:
+        str: 一行数组元素文本（包含换行符）
+    """
+    for i in range(0, len(data), bytes_per_line):
+        line = "0x" + data[i:i+bytes_per_line].hex(" ").replace(" ", ", 0x")
+        yield line + (" \n" if last and i + bytes_per_line >= len(data) else ", \n")
+
+
+def pcm_to_c_header(pcm_stream, header_path, array_name, log=print):
+    """
+    将 PCM 数据流转换为 C 头文件格式
+    
+    按块读取 PCM 数据并逐行写入头文件，不在内存中保存完整的 PCM 数据或文件内容。
+    
+    Args:
+        pcm_stream: PCM 数据流（二进制可读对象）
         header_path: 输出的头文件路径
         array_name: C 数组名称
+        log: 输出提示信息的函数
     
     Returns:
-        bool: 转换是否成功
+        int: PCM 数据字节数，失败时返回 0
     """
     try:
-        # 读取 PCM 数据
-        with open(pcm_path, 'rb') as f:
-            pcm_data = f.read()
-        
-        if len(pcm_data) == 0:
-            print(f"❌ PCM 文件为空: {pcm_path}")
-            return False
-        
-        # 生成 C 头文件内容
-        header_content = f"""#include <stdio.h>
-const unsigned char {array_name}[] = {{
-"""
-        
-        # 将字节数据转换为十六进制格式，每行16个字节
-        for i in range(0, len(pcm_data), 16):
-            line_data = pcm_data[i:i+16]
-            hex_values = [f"0x{byte:02x}" for byte in line_data]
-            header_content += ", ".join(hex_values) + ", \n"
-        
-        # 移除最后的逗号和换行，添加结束括号
-        header_content = header_content.rstrip(", \n") + " \n"
-        header_content += "};\n"
-        header_content += f"const unsigned int {array_name}_len = {len(pcm_data)};\n"
-        
-        # 写入头文件
         with open(header_path, 'w', encoding='utf-8') as f:
-            f.write(header_content)
+            f.write(f"""#include <stdio.h>
+const unsigned char {array_name}[] = {{
+""")
+            
+            # 最后一行末尾不带逗号，因此始终保留最后一行（至少 1 个字节）到读完后再写入
+            pending = b''
+            pcm_size = 0
+            while True:
+                block = pcm_stream.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                pcm_size += len(block)
+                data = pending + block
+                cut = (len(data) - 1) // 16 * 16
+                f.writelines(format_hex_lines(data[:cut], last=False))
+                pending = data[cut:]
+            
+            if pcm_size == 0:
+                log(f"❌ PCM 数据为空: {array_name}")
+                return 0
+            
+            f.writelines(format_hex_lines(pending))
+            f.write("};\n")
+            f.write(f"const unsigned int {array_name}_len = {pcm_size};\n")
         
-        print(f"✓ 生成头文件: {header_path} (数组大小: {len(pcm_data)} 字节)")
-        return True
+        return pcm_size
         
     except Exception as e:
-        print(f"❌ 生成头文件失败: {e}")
-        return False
+        log(f"❌ 生成头文件失败: {e}")
+        return 0
 
 
-def convert_audio_file(mp3_path, output_dir):
+def convert_audio_file(mp3_path, output_dir, log=print):
     """
     转换单个音频文件
     
     Args:
         mp3_path: MP3 文件路径
         output_dir: 输出目录
+        log: 输出提示信息的函数，并行转换时用于收集每个文件的信息
     
     Returns:
         bool: 转换是否成功
@@ -144,31 +163,49 @@ def convert_audio_file(mp3_path, output_dir):
     base_name = mp3_path.stem  # 不包含扩展名的文件名
     header_path = output_dir / f"{base_name}.h"
     array_name = base_name  # 使用文件名作为数组名
+    # 先写入临时文件，转换成功后再替换，失败时不破坏已有的头文件
+    temp_header_path = output_dir / f"{base_name}.h.tmp"
     
-    print(f"🔄 正在转换: {mp3_path.name}")
-    
-    # 创建临时 PCM 文件
-    with tempfile.NamedTemporaryFile(suffix='.pcm', delete=False) as temp_pcm:
-        temp_pcm_path = temp_pcm.name
+    log(f"🔄 正在转换: {mp3_path.name}")
     
-    try:
-        # 第一步：MP3 转 PCM
-        if not convert_mp3_to_pcm(mp3_path, temp_pcm_path):
-            return False
-        
-        # 第二步：PCM 转 C 头文件
-        if not pcm_to_c_header(temp_pcm_path, header_path, array_name):
+    # ffmpeg 错误信息写入临时文件，进程结束后再读取
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            process = start_mp3_decoder(mp3_path, stderr_file)
+        except Exception as e:
+            log(f"❌ 转换过程中发生错误: {e}")
             return False
         
-        print(f"✅ 转换完成: {mp3_path.name} -> {header_path.name}")
-        return True
-        
-    finally:
-        # 清理临时文件
         try:
-            os.unlink(temp_pcm_path)
-        except:
-            pass
+            # ffmpeg 解码输出通过管道直接转换为 C 头文件
+            pcm_size = pcm_to_c_header(process.stdout, temp_header_path, array_name, log)
+            # 关闭管道后再等待，若中途出错未读完，ffmpeg 会因管道关闭而退出，不会阻塞
+            process.stdout.close()
+            process.wait()
+            
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                stderr = stderr_file.read().decode('utf-8', errors='replace')
+                log(f"❌ ffmpeg 转换失败: {stderr}")
+                return False
+            
+            if pcm_size == 0:
+                return False
+            
+            os.replace(temp_header_path, header_path)
+            log(f"✓ 生成头文件: {header_path} (数组大小: {pcm_size} 字节)")
+            log(f"✅ 转换完成: {mp3_path.name} -> {header_path.name}")
+            return True
+            
+        finally:
+            # 确保 ffmpeg 进程结束，并清理临时文件
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            try:
+                os.unlink(temp_header_path)
+            except OSError:
+                pass
 
 
 def main():
@@ -209,12 +246,23 @@ def main():
     
     print("\n🔄 开始转换...")
     
-    # 转换每个文件
+    def convert_and_collect(mp3_file):
+        """转换单个文件，收集其提示信息，避免多个线程的输出交错"""
+        messages = []
+        success = convert_audio_file(mp3_file, mock_voices_dir, log=messages.append)
+        return success, messages
+    
+    # 并行转换每个文件（ffmpeg 在独立进程中运行，线程只负责等待子进程）
+    # 按文件顺序输出各自的提示信息
     success_count = 0
-    for mp3_file in mp3_files:
-        if convert_audio_file(mp3_file, mock_voices_dir):
-            success_count += 1
-        print()  # 空行分隔
+    max_workers = min(len(mp3_files), os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for success, messages in executor.map(convert_and_collect, mp3_files):
+            for message in messages:
+                print(message)
+            print()  # 空行分隔
+            if success:
+                success_count += 1
     
     # 输出结果
     print("=" * 50)